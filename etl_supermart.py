@@ -13,7 +13,11 @@
 # ==========================
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use("Agg")  # Backend no interactivo: los gráficos solo se guardan en archivos
 import matplotlib.pyplot as plt
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 from datetime import datetime
 import os
 from textwrap import dedent
@@ -25,8 +29,11 @@ from textwrap import dedent
 def safe_read_csv(path, **kwargs):
     """
     Lee un archivo CSV y maneja errores comunes.
+    Por defecto usa el lector de PyArrow con columnas respaldadas por Arrow.
     Devuelve el DataFrame y el estado de la carga.
     """
+    kwargs.setdefault("engine", "pyarrow")
+    kwargs.setdefault("dtype_backend", "pyarrow")
     try:
         df = pd.read_csv(path, **kwargs)
         status = "OK"
@@ -39,6 +46,85 @@ def safe_read_csv(path, **kwargs):
     return df, status
 
 
+def safe_read_csv_chunks(path, transform, chunksize, **kwargs):
+    """
+    Lee un archivo CSV por bloques, aplica `transform` a cada uno y maneja errores comunes.
+    `transform` devuelve el bloque transformado y un dict de conteos, que se suman entre bloques.
+    Evita mantener en memoria el archivo crudo completo junto a su versión transformada.
+    Devuelve el DataFrame transformado, los registros leídos, los conteos y el estado de la carga.
+    """
+    parts, n_rows, counts = [], 0, {}
+    try:
+        with pd.read_csv(path, chunksize=chunksize, **kwargs) as reader:
+            for chunk in reader:
+                n_rows += len(chunk)
+                part, part_counts = transform(chunk)
+                parts.append(part)
+                for k, v in part_counts.items():
+                    counts[k] = counts.get(k, 0) + v
+        status = "OK"
+    except FileNotFoundError:
+        parts, n_rows, counts = [], 0, {}
+        status = "ERROR: Archivo no encontrado"
+    except pd.errors.ParserError as e:
+        parts, n_rows, counts = [], 0, {}
+        status = f"ERROR de formato: {e}"
+    if not parts:
+        df = pd.DataFrame()
+    elif len(parts) == 1:
+        # Un único bloque se devuelve tal cual, sin la copia que haría pd.concat
+        df = parts[0]
+    else:
+        df = pd.concat(parts)
+    return df, n_rows, counts, status
+
+
+def mark_seen_ids(seen, ids):
+    """
+    Marca cuáles de los `ids` (distintos entre sí, Int64) ya estaban en `seen` y agrega los nuevos.
+    `seen` guarda los ids vistos como un arreglo int64 ordenado (8 bytes por id) y una
+    bandera para el id nulo. Devuelve la máscara de ids ya vistos.
+    """
+    is_na = np.asarray(ids.isna(), dtype=bool)
+    values = ids.to_numpy(dtype=np.int64, na_value=0)
+    # Con las llaves ordenadas la búsqueda binaria recorre `seen` casi secuencialmente
+    order = np.argsort(values)
+    sorted_values = values[order]
+    pos = np.searchsorted(seen["ids"], sorted_values)
+    found = np.zeros(len(values), dtype=bool)
+    hit = pos < len(seen["ids"])
+    found[hit] = seen["ids"][pos[hit]] == sorted_values[hit]
+    seen_before = np.empty(len(values), dtype=bool)
+    seen_before[order] = found
+    seen_before[is_na] = seen["na"]
+    # Los ids nuevos se insertan en su posición, sin volver a ordenar el arreglo
+    new = ~found & ~is_na[order]
+    seen["ids"] = np.insert(seen["ids"], pos[new], sorted_values[new])
+    seen["na"] = seen["na"] or bool(is_na.any())
+    return seen_before
+
+
+def write_dataset(df, path, fmt):
+    """
+    Guarda un DataFrame en Parquet (compresión zstd) o en CSV según `fmt`.
+    El CSV se escribe con el escritor multihilo de PyArrow.
+    La extensión de `path` se ajusta al formato; devuelve la ruta final.
+    """
+    root, _ = os.path.splitext(path)
+    if fmt == "parquet":
+        path = root + ".parquet"
+        df.to_parquet(path, engine="pyarrow", compression="zstd", index=False)
+    else:
+        path = root + ".csv"
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        # Las fechas del pipeline no tienen hora: se escriben como "YYYY-MM-DD"
+        for i, field in enumerate(table.schema):
+            if pa.types.is_timestamp(field.type):
+                table = table.set_column(i, field.name, table.column(i).cast(pa.date32()))
+        pa_csv.write_csv(table, path)
+    return path
+
+
 def write_text(path, text):
     """Guarda texto (por ejemplo, reportes) en un archivo."""
     with open(path, "w", encoding="utf-8") as f:
@@ -49,6 +135,10 @@ def write_text(path, text):
 # ==========================================================
 # Carpeta de trabajo donde se crearán los archivos
 base = "/mnt/data"
+# Filas de ventas que se leen y transforman a la vez
+chunk_size = 500_000
+# Formato del dataset transformado y del Data Mart: "parquet" o "csv"
+output_format = "parquet"
 
 # ==========================================================
 # 3. FASE DE EXTRACCIÓN (E)
@@ -60,72 +150,137 @@ ventas_path = os.path.join(base, "ventas_crudas.csv")
 productos_path = os.path.join(base, "productos.csv")
 tiendas_path = os.path.join(base, "tiendas.csv")
 
-# Lectura de CSVs
+# Lectura de CSVs (las ventas se leen por bloques durante la transformación)
 read_kwargs = dict(dtype={
     "order_id": "Int64",
-    "producto_id": "string",
+    "producto_id": "string[pyarrow]",
     "cantidad": "Int64",
     "precio_unitario": "float",
-    "cliente_id": "string",
-    "tienda_id": "string",
+    "cliente_id": "string[pyarrow]",
+    "tienda_id": "string[pyarrow]",
     "fecha": "string",
 })
-ventas_raw, s1 = safe_read_csv(ventas_path, **read_kwargs)
-productos, s2 = safe_read_csv(productos_path)
-tiendas, s3 = safe_read_csv(tiendas_path)
-
-# Estadísticas de carga
-print("\n===== FASE 1: EXTRACCIÓN =====")
-print(f"Ventas: {len(ventas_raw)} registros | Estado: {s1}")
-print(f"Productos: {len(productos)} registros | Estado: {s2}")
-print(f"Tiendas: {len(tiendas)} registros | Estado: {s3}")
+productos, s2 = safe_read_csv(productos_path, dtype={
+    "producto_id": "string[pyarrow]",
+    "categoria": "category",
+    "subcategoria": "string[pyarrow]",
+    "marca": "string[pyarrow]",
+})
+tiendas, s3 = safe_read_csv(tiendas_path, dtype={
+    "tienda_id": "string[pyarrow]",
+    "ciudad": "category",
+    "region": "category",
+    "gerente": "string[pyarrow]",
+})
 
 # ==========================================================
 # 4. FASE DE TRANSFORMACIÓN (T)
 # ==========================================================
 # Objetivo: Limpiar, estandarizar y enriquecer los datos para análisis.
 
-df = ventas_raw.copy()
-
-# --- Limpieza de fechas ---
-# Algunas fechas vienen en formatos distintos ("YYYY-MM-DD", "DD-MM-YYYY")
-df["fecha"] = pd.to_datetime(df["fecha"], errors="coerce", format="%Y-%m-%d") \
-    .combine_first(pd.to_datetime(df["fecha"], errors="coerce", format="%d-%m-%Y"))
-
-# --- Completar valores nulos ---
-df["cliente_id"] = df["cliente_id"].fillna("CLIENTE_DESCONOCIDO")
+# Los catálogos se indexan por su llave una sola vez para enriquecer cada bloque de ventas
+prod_lookup = productos.set_index("producto_id")
+tienda_lookup = tiendas.set_index("tienda_id")
 
-# --- Eliminar duplicados ---
-duplicated_ids = df[df["order_id"].duplicated(keep="first")]["order_id"].tolist()
-df = df.drop_duplicates(subset=["order_id"], keep="first")
+weekday_names = np.array(["Lunes","Martes","Miércoles","Jueves","Viernes","Sábado","Domingo"], dtype=object)
+# Clases de venta: Baja (< 20), Media ([20, 50)) y Alta (>= 50)
+venta_edges = np.array([20.0, 50.0])
+categoria_venta_dtype = pd.CategoricalDtype(["Baja", "Media", "Alta"], ordered=True)
 
-# --- Cálculo de métricas ---
-df["venta_total"] = (df["cantidad"].astype(float) * df["precio_unitario"].astype(float)).round(2)
 
-# --- Clasificación de ventas ---
-bins = [-np.inf, 20, 50, np.inf]
-labels = ["Baja", "Media", "Alta"]
-df["categoria_venta"] = pd.cut(df["venta_total"], bins=bins, labels=labels, right=False)
-
-# --- Enriquecimiento con catálogos ---
-df = df.merge(productos, on="producto_id", how="left", validate="m:1")
-df = df.merge(tiendas, on="tienda_id", how="left", validate="m:1")
+def transform_ventas(df, seen_ids):
+    """
+    Limpia, estandariza y enriquece un bloque de ventas crudas.
+    `seen_ids` guarda los order_id de bloques anteriores (ver mark_seen_ids).
+    Devuelve el bloque transformado y sus indicadores de calidad.
+    """
+    # --- Limpieza de fechas ---
+    # Algunas fechas vienen en formatos distintos ("YYYY-MM-DD", "DD-MM-YYYY")
+    # Se parsea primero "YYYY-MM-DD" y solo las filas sin fecha válida se reintentan en "DD-MM-YYYY"
+    fecha_raw = df["fecha"]
+    df["fecha"] = pd.to_datetime(fecha_raw, errors="coerce", format="%Y-%m-%d")
+    mask = df["fecha"].isna()
+    df.loc[mask, "fecha"] = pd.to_datetime(fecha_raw[mask], errors="coerce", format="%d-%m-%Y")
+
+    # --- Completar valores nulos ---
+    df["cliente_id"] = df["cliente_id"].fillna("CLIENTE_DESCONOCIDO")
+
+    # --- Eliminar duplicados ---
+    # Un order_id se conserva solo en su primera aparición del bloque y si no apareció en
+    # uno anterior. factorize numera los ids en orden de aparición, así que una fila es la
+    # primera de su id cuando su código supera a todos los anteriores. Solo los ids distintos
+    # del bloque se buscan entre los vistos.
+    codes, uniques = pd.factorize(df["order_id"], use_na_sentinel=False)
+    prev_max = np.maximum.accumulate(np.concatenate(([-1], codes))[:-1])
+    seen_before = mark_seen_ids(seen_ids, uniques)
+    df = df[(codes > prev_max) & ~seen_before[codes]].copy(deep=False)
+
+    # --- Tipos numéricos compactos ---
+    # Las cantidades de venta minorista caben en enteros pequeños; los precios se dejan en float64
+    df["cantidad"] = pd.to_numeric(df["cantidad"], downcast="integer")
+
+    # --- Cálculo de métricas ---
+    # Precio y venta_total se mantienen en float64 para conservar los centavos de montos altos.
+    # El producto y el redondeo se hacen en el mismo buffer, sin arreglos intermedios
+    venta = df["cantidad"].to_numpy(dtype=np.float64, na_value=np.nan, copy=True)
+    np.multiply(venta, df["precio_unitario"].to_numpy(), out=venta)
+    np.round(venta, 2, out=venta)
+    df["venta_total"] = venta
+
+    # --- Clasificación de ventas ---
+    # Búsqueda binaria sobre los límites; las ventas nulas quedan sin clase (código -1)
+    clase_codes = np.searchsorted(venta_edges, venta, side="right")
+    clase_codes[np.isnan(venta)] = -1
+    df["categoria_venta"] = pd.Categorical.from_codes(clase_codes, dtype=categoria_venta_dtype)
+
+    # --- Enriquecimiento con catálogos ---
+    # Los catálogos tienen llaves únicas, así que basta una búsqueda por llave en lugar de un merge
+    df[prod_lookup.columns] = prod_lookup.reindex(df["producto_id"]).set_axis(df.index)
+    df[tienda_lookup.columns] = tienda_lookup.reindex(df["tienda_id"]).set_axis(df.index)
+
+    # --- Dimensiones temporales ---
+    # Año, mes y día de la semana salen de una sola conversión a días desde 1970-01-01
+    # (un jueves); las fechas nulas (NaT) quedan sin año, mes ni día
+    dias = df["fecha"].to_numpy(dtype="datetime64[D]")
+    fecha_valid = ~np.isnat(dias)
+    meses = dias.astype("datetime64[M]").astype(np.int64)
+    df["anio"] = pd.arrays.IntegerArray((meses // 12 + 1970).astype(np.int16), ~fecha_valid)
+    df["mes"] = pd.arrays.IntegerArray((meses % 12 + 1).astype(np.int8), ~fecha_valid)
+    # Indexación directa sobre el arreglo de nombres
+    dow = (dias[fecha_valid].astype(np.int64) + 3) % 7
+    dia_semana = np.full(len(df), np.nan, dtype=object)
+    dia_semana[fecha_valid] = weekday_names[dow]
+    df["dia_semana"] = dia_semana
+
+    # --- Indicadores de calidad ---
+    # Se cuentan mientras el bloque sigue en memoria, sin recorrer luego el dataset completo
+    counts = {
+        "Fechas Válidas": int(np.count_nonzero(fecha_valid)),
+        "Cantidades Positivas": int((df["cantidad"] > 0).sum()),
+        "Precios Positivos": int(np.count_nonzero(df["precio_unitario"].to_numpy() > 0)),
+        "Productos No Encontrados": int(df["categoria"].isna().sum()),
+        "Tiendas No Encontradas": int(df["ciudad"].isna().sum()),
+    }
+    return df, counts
+
+
+# Los order_id vistos se reinician en cada ejecución de la lectura por bloques
+seen_ids = {"ids": np.empty(0, dtype=np.int64), "na": False}
+df, n_ventas, quality_counts, s1 = safe_read_csv_chunks(
+    ventas_path, lambda chunk: transform_ventas(chunk, seen_ids), chunk_size, **read_kwargs)
 
-# --- Dimensiones temporales ---
-weekday_map = {0:"Lunes",1:"Martes",2:"Miércoles",3:"Jueves",4:"Viernes",5:"Sábado",6:"Domingo"}
-df["anio"] = df["fecha"].dt.year
-df["mes"] = df["fecha"].dt.month
-df["dia_semana"] = df["fecha"].dt.dayofweek.map(weekday_map)
+# Estadísticas de carga
+print("\n===== FASE 1: EXTRACCIÓN =====")
+print(f"Ventas: {n_ventas} registros | Estado: {s1}")
+print(f"Productos: {len(productos)} registros | Estado: {s2}")
+print(f"Tiendas: {len(tiendas)} registros | Estado: {s3}")
 
 # --- Control de calidad ---
 quality = {
     "Registros Totales": len(df),
-    "Duplicados Removidos": len(duplicated_ids),
-    "Fechas Válidas": df["fecha"].notna().sum(),
-    "Cantidades Positivas": (df["cantidad"] > 0).sum(),
-    "Precios Positivos": (df["precio_unitario"] > 0).sum(),
-    "Productos No Encontrados": df["categoria"].isna().sum(),
-    "Tiendas No Encontradas": df["ciudad"].isna().sum()
+    # La deduplicación es el único paso que descarta filas
+    "Duplicados Removidos": n_ventas - len(df),
+    **quality_counts
 }
 print("\n===== FASE 2: TRANSFORMACIÓN =====")
 for k,v in quality.items(): print(f"{k}: {v}")
@@ -136,32 +291,47 @@ for k,v in quality.items(): print(f"{k}: {v}")
 # Objetivo: Exportar los resultados limpios, optimizados y resumidos.
 
 # --- Dataset transformado completo ---
-dataset_path = os.path.join(base, "ventas_transformadas.csv")
-df.to_csv(dataset_path, index=False)
+dataset_path = write_dataset(df, os.path.join(base, "ventas_transformadas.csv"), output_format)
 print(f"\nArchivo transformado guardado en: {dataset_path}")
 
 # --- Data Mart agregado ---
+# Las llaves de baja cardinalidad se agrupan sobre códigos categóricos, sin ordenar el resultado
+for c in ("dia_semana", "ciudad", "region", "categoria"):
+    df[c] = df[c].astype("category")
+# Solo se pasan al groupby las llaves y las columnas que se agregan
+mart_keys = ["fecha","anio","mes","dia_semana","ciudad","region","categoria"]
 data_mart = (
-    df.groupby(["fecha","anio","mes","dia_semana","ciudad","region","categoria"])
+    df[mart_keys + ["order_id","cantidad","venta_total"]]
+      .groupby(mart_keys, observed=True, sort=False)
       .agg(transacciones=("order_id","count"),
            unidades=("cantidad","sum"),
            ventas=("venta_total","sum"))
       .reset_index()
 )
-data_mart_path = os.path.join(base, "data_mart_ventas.csv")
-data_mart.to_csv(data_mart_path, index=False)
+data_mart_path = write_dataset(data_mart, os.path.join(base, "data_mart_ventas.csv"), output_format)
 print(f"Data Mart guardado en: {data_mart_path}")
 
 # --- Resumen ejecutivo ---
+# Agregaciones reutilizadas en el resumen, los gráficos y el reporte
+ventas_por_ciudad = df.groupby("ciudad", observed=True)["venta_total"].sum()
+ventas_por_categoria = df.groupby("categoria", observed=True)["venta_total"].sum()
+ventas_total_sum = df["venta_total"].sum()
+ventas_mean = df["venta_total"].mean()
+# Tras la deduplicación cada order_id no nulo es único: contarlos equivale a nunique()
+n_transacciones = df["order_id"].count()
+clientes_unicos = df["cliente_id"].nunique()
+top_ciudad = ventas_por_ciudad.idxmax()
+top_categoria = ventas_por_categoria.idxmax()
+
 resumen = pd.DataFrame({
     "Métrica": ["Ventas Totales","Transacciones","Ticket Promedio","Clientes Únicos","Top Ciudad","Top Categoría"],
     "Valor": [
-        round(df["venta_total"].sum(),2),
-        df["order_id"].nunique(),
-        round(df["venta_total"].mean(),2),
-        df["cliente_id"].nunique(),
-        df.groupby("ciudad")["venta_total"].sum().idxmax(),
-        df.groupby("categoria")["venta_total"].sum().idxmax()
+        round(ventas_total_sum,2),
+        n_transacciones,
+        round(ventas_mean,2),
+        clientes_unicos,
+        top_ciudad,
+        top_categoria
     ]
 })
 resumen_path = os.path.join(base, "resumen_ejecutivo.csv")
@@ -173,29 +343,36 @@ print(f"Resumen ejecutivo guardado en: {resumen_path}")
 # ==========================================================
 # Objetivo: Crear gráficos que ayuden a comprender el desempeño comercial.
 
-plt.figure()
-df.groupby("ciudad")["venta_total"].sum().plot(kind="bar")
-plt.title("Ventas totales por ciudad")
-plt.tight_layout()
-plt.savefig(os.path.join(base,"grafico_ventas_por_ciudad.png"))
-
-plt.figure()
-df.groupby("categoria")["venta_total"].sum().plot(kind="pie", autopct="%1.1f%%")
-plt.title("Distribución de ventas por categoría")
-plt.tight_layout()
-plt.savefig(os.path.join(base,"grafico_distribucion_por_categoria.png"))
-
-plt.figure()
-df.groupby("dia_semana")["order_id"].count().plot(kind="bar")
-plt.title("Transacciones por día de la semana")
-plt.tight_layout()
-plt.savefig(os.path.join(base,"grafico_transacciones_por_dia.png"))
-
-plt.figure()
-plt.hist(df["venta_total"], bins=10)
-plt.title("Distribución de montos de venta")
-plt.tight_layout()
-plt.savefig(os.path.join(base,"histograma_montos_venta.png"))
+# Una sola figura reutilizada: los ejes se limpian entre un gráfico y otro
+fig, ax = plt.subplots()
+
+ventas_por_ciudad.plot(kind="bar", ax=ax)
+ax.set_title("Ventas totales por ciudad")
+fig.tight_layout()
+fig.savefig(os.path.join(base,"grafico_ventas_por_ciudad.png"))
+
+ax.clear()
+df.groupby("dia_semana", observed=True)["order_id"].count().plot(kind="bar", ax=ax)
+ax.set_title("Transacciones por día de la semana")
+fig.tight_layout()
+fig.savefig(os.path.join(base,"grafico_transacciones_por_dia.png"))
+
+ax.clear()
+# Se agrupa directamente con NumPy; con un rango explícito las ventas nulas (NaN) se ignoran
+montos = df["venta_total"].to_numpy()
+counts, edges = np.histogram(montos, bins=10, range=(np.nanmin(montos), np.nanmax(montos)))
+ax.bar(edges[:-1], counts, width=np.diff(edges), align="edge")
+ax.set_title("Distribución de montos de venta")
+fig.tight_layout()
+fig.savefig(os.path.join(base,"histograma_montos_venta.png"))
+
+# La torta va al final: fija un aspecto igual y oculta el marco de los ejes
+ax.clear()
+ventas_por_categoria.plot(kind="pie", autopct="%1.1f%%", ax=ax)
+ax.set_title("Distribución de ventas por categoría")
+fig.tight_layout()
+fig.savefig(os.path.join(base,"grafico_distribucion_por_categoria.png"))
+plt.close(fig)
 
 print("\nGráficos generados correctamente.")
 
@@ -209,14 +386,14 @@ REPORTE EJECUTIVO – SuperMart Colombia
 Fecha de generación: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
 
 1) Métricas principales:
-- Ventas Totales: ${df['venta_total'].sum():,.2f}
-- Transacciones: {df['order_id'].nunique()}
-- Ticket Promedio: ${df['venta_total'].mean():.2f}
-- Clientes Únicos: {df['cliente_id'].nunique()}
+- Ventas Totales: ${ventas_total_sum:,.2f}
+- Transacciones: {n_transacciones}
+- Ticket Promedio: ${ventas_mean:.2f}
+- Clientes Únicos: {clientes_unicos}
 
 2) Top Performers:
-- Ciudad líder: {df.groupby('ciudad')['venta_total'].sum().idxmax()}
-- Categoría líder: {df.groupby('categoria')['venta_total'].sum().idxmax()}
+- Ciudad líder: {top_ciudad}
+- Categoría líder: {top_categoria}
 
 3) Indicadores de calidad de datos:
 {quality}